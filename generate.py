@@ -1,9 +1,32 @@
 import sys
 import numpy
-import math
+from collections import Counter, deque
 from crossword import *
 
 
+def array_to_mask(bits):
+    """
+    Return the int bitmask whose bit k is set iff `bits[k]` is true.
+    """
+    packed = numpy.packbits(bits, bitorder="little")
+    return int.from_bytes(packed.tobytes(), "little")
+
+
+def revise_kernel(mask_x, mask_y, support_x, support_y):
+    """
+    Return the bits of `mask_x` that are kept when revising against `mask_y`.
+    `support_x` and `support_y` map each letter to the words having it at
+    the overlap. A word of `x` is kept if some word of `y` has the same
+    letter there, so the letters available in `y` are found once and the
+    words of `x` using them are selected with one mask per letter.
+    """
+    allowed = 0
+    for letter, mask in support_y.items():
+        if mask & mask_y and letter in support_x:
+            allowed |= support_x[letter]
+    return mask_x & allowed
+
+
 class CrosswordCreator():
 
     def __init__(self, crossword):
@@ -11,11 +34,108 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
-        self.domains = {
-            var: self.crossword.words.copy()
+
+        # The neighbors of a variable never change, compute them only once
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.crossword.variables
+        }
+        self._degree = {var: len(ns) for var, ns in self._neighbors.items()}
+
+        # `_cellmap[i, j]` lists the `(var, k)` pairs of the variables whose
+        # kth character is in cell (i, j)
+        self._cellmap = dict()
+        for var in self.crossword.variables:
+            for k, cell in enumerate(var.cells):
+                self._cellmap.setdefault(cell, []).append((var, k))
+
+        # Each word gets a fixed index, so that a domain can be stored as an
+        # int bitmask where bit k is set if word k is in the domain.
+        # Words are grouped by length, so each length is a contiguous block
+        # (empty lines of the words file are dropped, no variable fits them)
+        self.words = sorted(
+            (w for w in self.crossword.words if w), key=lambda w: (len(w), w)
+        )
+        self.word_idx = {w: k for k, w in enumerate(self.words)}
+
+        # letter_mask[var][pos][ch] is the bitmask of the words with the
+        # length of `var` whose character at `pos` is `ch`
+        # length_mask[length] is the bitmask of the words of that length
+        # Both are built from a (n_words, length) matrix of character codes
+        by_length = dict()
+        self.length_mask = dict()
+        start = 0
+        while start < len(self.words):
+            length = len(self.words[start])
+            end = start
+            while end < len(self.words) and len(self.words[end]) == length:
+                end += 1
+            block = self.words[start:end]
+            chars = numpy.array(block, dtype=f"U{length}")
+            chars = chars.view(numpy.uint32).reshape(len(block), length)
+
+            self.length_mask[length] = ((1 << len(block)) - 1) << start
+            by_length[length] = []
+            for pos in range(length):
+                column = chars[:, pos]
+                by_length[length].append({
+                    chr(code): array_to_mask(column == code) << start
+                    for code in numpy.unique(column).tolist()
+                })
+            start = end
+
+        self.letter_mask = {
+            var: by_length.get(var.length, [dict() for _ in range(var.length)])
+            for var in self.crossword.variables
+        }
+
+        # Flattened overlaps, so that the hot paths avoid indexing the
+        # overlap tuples: `_overlaps[var]` lists `(n, i, j)` for each neighbor
+        # `n`, where var's ith character overlaps n's jth character, and
+        # `_arc_support[x, y]` holds the letter masks of `x` and `y` at their
+        # overlap
+        self._overlaps = {var: [] for var in self.crossword.variables}
+        self._arc_support = dict()
+        for (x, y), overlap in self.crossword.overlaps.items():
+            if overlap is not None:
+                self._overlaps[x].append((y, overlap[0], overlap[1]))
+                self._arc_support[x, y] = (
+                    self.letter_mask[x][overlap[0]],
+                    self.letter_mask[y][overlap[1]]
+                )
+
+        # The domain of each variable starts as the words of its length
+        self.domain_mask = {
+            var: self.length_mask.get(var.length, 0)
             for var in self.crossword.variables
         }
 
+    @property
+    def domains(self):
+        """
+        Mapping from each variable to the set of words in its domain.
+        It is built from `self.domain_mask`, which is what the solver updates,
+        so it is read-only and changes to it are not seen by the solver.
+        """
+        return {var: self.domain(var) for var in self.domain_mask}
+
+    def domain(self, var):
+        """
+        Return the set of words currently in the domain of `var`.
+        """
+        n_bytes = (len(self.words) + 7) // 8
+        packed = self.domain_mask[var].to_bytes(n_bytes, "little")
+        bits = numpy.unpackbits(
+            numpy.frombuffer(packed, dtype=numpy.uint8), bitorder="little"
+        )
+        return {self.words[k] for k in numpy.flatnonzero(bits).tolist()}
+
+    def domain_size(self, var):
+        """
+        Return the number of words currently in the domain of `var`.
+        """
+        return self.domain_mask[var].bit_count()
+
     def letter_grid(self, assignment):
         """
         Return 2D array representing a given assignment.
@@ -36,14 +156,21 @@ class CrosswordCreator():
         """
         Print crossword assignment to the terminal.
         """
-        letters = self.letter_grid(assignment)
         for i in range(self.crossword.height):
+            row = []
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    # letter of the first assigned variable covering the cell
+                    out = " "
+                    for var, k in self._cellmap.get((i, j), ()):
+                        word = assignment.get(var)
+                        if word:
+                            out = word[k]
+                            break
+                    row.append(out)
                 else:
-                    print("█", end="")
-            print()
+                    row.append("█")
+            print("".join(row))
 
     def save(self, assignment, filename):
         """
@@ -96,53 +223,43 @@ class CrosswordCreator():
 
     def enforce_node_consistency(self):
         """
-        Update `self.domains` such that each variable is node-consistent.
+        Update `self.domains` (stored as `self.domain_mask`) such that each
+        variable is node-consistent.
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
-        """
 
-        for var, words in self.domains.items():
-            to_be_removed = []
-            for w in words:
-                if len(w) != var.length:
-                    to_be_removed.append(w)
-
-            self.domains[var].difference_update(to_be_removed)
+        The domains are already built from the words of the right length in
+        `__init__`, so there is nothing left to remove.
+        """
 
     def revise(self, x, y):
         """
         Make variable `x` arc consistent with variable `y`.
-        To do so, remove values from `self.domains[x]` for which there is no
-        possible corresponding value for `y` in `self.domains[y]`.
+        To do so, remove values from the domain of `x` for which there is no
+        possible corresponding value for `y` in the domain of `y`.
 
         Return True if a revision was made to the domain of `x`; return
         False if no revision was made.
         """
         revision = False
-        # get the overlaps
-        overlaps = self.crossword.overlaps[(x, y)]
-        word_v1 = self.domains[x]
-        word_v2 = self.domains[y]
-
-        if overlaps is not None:
-            to_removed = []
-            for w1 in word_v1:
-                found = False
-                for w2 in word_v2:
-                    if w1[overlaps[0]] == w2[overlaps[1]]:
-                        found = True
-                        break
-                if not found:
-                    to_removed.append(w1)
-            self.domains[x].difference_update(to_removed)
-            if len(to_removed) != 0:
+        # get the letter masks at the overlap
+        supports = self._arc_support.get((x, y))
+
+        if supports is not None:
+            mask_v1 = self.domain_mask[x]
+            kept = revise_kernel(
+                mask_v1, self.domain_mask[y], supports[0], supports[1]
+            )
+            if kept != mask_v1:
+                self.domain_mask[x] = kept
                 revision = True
 
         return revision
 
     def ac3(self, arcs=None):
         """
-        Update `self.domains` such that each variable is arc consistent.
+        Update `self.domains` (stored as `self.domain_mask`) such that each
+        variable is arc consistent.
         If `arcs` is None, begin with initial list of all arcs in the problem.
         Otherwise, use `arcs` as the initial list of arcs to make consistent.
 
@@ -152,16 +269,22 @@ class CrosswordCreator():
         if arcs is None:
             arcs = [var for var, a in self.crossword.overlaps.items() if a is not None]
 
+        # FIFO queue of pending arcs, plus a set to avoid queuing duplicates
+        arcs = deque(arcs)
+        in_queue = set(arcs)
+
         while len(arcs) != 0:
-            arc = arcs[0]
-            arcs.remove(arc)
+            arc = arcs.popleft()
+            in_queue.discard(arc)
             if self.revise(arc[0], arc[1]):
-                if len(self.domains[arc[0]]) == 0:
+                if self.domain_mask[arc[0]] == 0:
                     return False
                 else:
-                    for var in self.crossword.neighbors(arc[0]):
-                        if var != arc[1]:
+                    for var in self._neighbors[arc[0]]:
+                        if var != arc[1] and (var, arc[0]) not in in_queue:
                             arcs.append((var, arc[0]))
+                            in_queue.add((var, arc[0]))
+        return True
 
     def assignment_complete(self, assignment):
         """
@@ -184,25 +307,29 @@ class CrosswordCreator():
         puzzle without conflicting characters); return False otherwise.
         """
         # check if value of each variable are distinct
-        values = list(assignment.values())
-        lst, counts = numpy.unique(values, return_counts=True)
-        if not all(counts == 1):
+        values = assignment.values()
+        if len(set(values)) != len(values):
             return False
 
+        # check length and overlaping consistency of each variable
         for var, val in assignment.items():
-
-            # check length
-            if len(val) != var.length:
+            if not self.consistent_with(var, val, assignment):
                 return False
+        return True
+
+    def consistent_with(self, var, val, assignment):
+        """
+        Return True if assigning `val` to `var` keeps the consistent partial
+        `assignment` consistent; return False otherwise.
+        Only the length of `val` and its overlaps with the neighbors of `var`
+        are checked; distinct words are checked by the caller.
+        """
+        if len(val) != var.length:
+            return False
 
-            # check overlaping consistency
-            for n in self.crossword.neighbors(var):
-                r = self.crossword.overlaps[(var, n)]
-                if n in assignment:
-                    word_v2 = {assignment[n]}
-                    for w2 in word_v2:
-                        if val[r[0]] != w2[r[1]]:
-                            return False
+        for n, i, j in self._overlaps[var]:
+            if n in assignment and val[i] != assignment[n][j]:
+                return False
         return True
 
     def order_domain_values(self, var, assignment):
@@ -212,21 +339,21 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        result = dict()
-        word_var = self.domains[var]
-        for n in self.crossword.neighbors(var):
+        result = Counter()
+        word_var = self.domain(var)
+        for n, i, j in self._overlaps[var]:
             if n not in assignment:
-                overlap = self.crossword.overlaps[var, n]
-                words_neighbor = self.domains[n]
+                mask_neighbor = self.domain_mask[n]
+                nb_neighbor = mask_neighbor.bit_count()
+                # number of words of `n` left for each letter at the overlap
+                nb_kept = {
+                    ch: (mask & mask_neighbor).bit_count()
+                    for ch, mask in self.letter_mask[n][j].items()
+                }
                 for w1 in word_var:
-                    nb_eliminated = 0
-                    for w2 in words_neighbor:
-                        if w1[overlap[0]] != w2[overlap[1]]:
-                            nb_eliminated += 1
-                            result[w1] = nb_eliminated
-
-        if len(result) == 0:
-            return word_var
+                    nb_eliminated = nb_neighbor - nb_kept.get(w1[i], 0)
+                    result[w1] += nb_eliminated
+
         values_sorted = sorted(word_var, key=result.__getitem__)
         return values_sorted
 
@@ -239,27 +366,10 @@ class CrosswordCreator():
         return values.
         """
         # Get all variables not in the assignment
+        uv = self.crossword.variables - assignment.keys()
 
-        uv = list(self.crossword.variables.difference(assignment.keys()))
-        uv_sorted = {var: len(self.domains[var]) for var in uv}
-
-        length = math.inf
-
-        # Get fewest values domains
-        for v, l in uv_sorted.items():
-            if l < length:
-                length = l
-        v_candidate = [var for var, l in uv_sorted.items() if l == length]
-        index = 0
-        if len(v_candidate) != 1:
-
-            n = len(self.crossword.neighbors(v_candidate[index]))
-            for i in range(1, len(v_candidate)):
-                if len(self.crossword.neighbors(v_candidate[i])) > n:
-                    n = len(self.crossword.neighbors(v_candidate[i]))
-                    index = i
-
-        return v_candidate[index]
+        # Fewest remaining values first, then highest degree
+        return min(uv, key=lambda v: (self.domain_size(v), -self._degree[v]))
 
     def backtrack(self, assignment):
         """
@@ -274,13 +384,24 @@ class CrosswordCreator():
             return assignment
         var = self.select_unassigned_variable(assignment)
         ordered_value_var = self.order_domain_values(var, assignment)
+        used = set(assignment.values())
 
         for v in ordered_value_var:
-            assignment[var] = v
-            if self.consistent(assignment):
-                result = self.backtrack(assignment)
-                if result is not None:
-                    return result
+            if v not in used and self.consistent_with(var, v, assignment):
+                assignment[var] = v
+
+                # Maintain arc consistency: reduce the domain of `var` to `v`
+                # and propagate to its unassigned neighbors, then restore the
+                # domains if this value does not lead to a solution
+                saved = self.domain_mask.copy()
+                self.domain_mask[var] = 1 << self.word_idx[v]
+                arcs = [(n, var) for n in self._neighbors[var] if n not in assignment]
+                if self.ac3(arcs):
+                    result = self.backtrack(assignment)
+                    if result is not None:
+                        return result
+                self.domain_mask = saved
+
                 assignment.pop(var)
         return None
 